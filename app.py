@@ -3,8 +3,12 @@ import streamlit as st
 import yfinance as yf
 import pandas as pd
 import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-import pytz
+from zoneinfo import ZoneInfo
+
+_TZ_NY = ZoneInfo('America/New_York')
 
 # --- 設定頁面 ---
 st.set_page_config(
@@ -16,82 +20,147 @@ st.set_page_config(
 
 # --- 核心邏輯區 (Rainow Brain) ---
 
-@st.cache_data(ttl=30) # 縮短緩存到 30秒，確保價格更即時
-def get_stock_data(ticker):
-   stock = yf.Ticker(ticker)
+# 報價快取以 30 秒為一格，同一時間格內的使用者共用同一份資料
+PRICE_BUCKET_SECONDS = 30
+
+@st.cache_resource(max_entries=100) # Ticker 物件跨 rerun / session 共用；代碼為自由輸入，需限制數量
+def get_ticker(symbol):
+   # 僅供 history() 使用 (每次呼叫都會重新抓取)；.info 等屬性在 Ticker 內只抓一次，
+   # 從這個長駐物件讀取會一直拿到舊資料
+   return yf.Ticker(symbol)
+
+def is_extended_session(now_ny=None):
+   # 美東平日 04:00–20:00 (盤前 + 盤中 + 盤後) 才有 1 分鐘報價
+   if now_ny is None:
+       now_ny = datetime.now(_TZ_NY)
+   return now_ny.weekday() < 5 and 4 <= now_ny.hour < 20
+
+def price_bucket():
+   return int(time.time() // PRICE_BUCKET_SECONDS)
+
+# 基本資料 (get_stock_info) 的快取秒數
+DAILY_CACHE_TTL = 86400
+# rainow_brain 只用得到這幾個基本面欄位
+INFO_KEYS = ('targetLowPrice', 'targetHighPrice', 'earningsGrowth', 'revenueGrowth')
+
+@st.cache_data(ttl=DAILY_CACHE_TTL) # 分析師預估變動很慢，與報價分開快取 1 天
+def get_stock_info(ticker):
+   # 每次建立新的 Ticker：快取中的 Ticker 會記住第一次抓到的 .info，TTL 到期也不會更新
+   info = yf.Ticker(ticker).info
+   return {k: info.get(k) for k in INFO_KEYS}
+
+@st.cache_data(ttl=PRICE_BUCKET_SECONDS * 2) # 快取鍵由 bucket 決定，TTL 僅作為保險
+def get_stock_data(ticker, bucket):
+   stock = get_ticker(ticker)
    
    # 1. 抓取日線 (計算指標用，較穩定) - 確保數據夠長
    hist_daily = stock.history(period="6mo")
    
    # 2. 抓取即時價格 (含盤前盤後) - 抓取 5 天以防週末空白
-   rt_data = stock.history(period="5d", interval="1m", prepost=True)
+   #    休市時段以日線收盤價為準，跳過最重的 1 分鐘請求
+   if is_extended_session():
+       rt_data = stock.history(period="5d", interval="1m", prepost=True)
+   else:
+       rt_data = pd.DataFrame()
    
-   info = stock.info
+   info = get_stock_info(ticker)
    return hist_daily, rt_data, info
 
+def rolling_sum(values, window):
+   # 以累積和差分計算滑動視窗總和，結果與 rolling(window).sum() 相同：
+   # 前 window-1 筆為 NaN；NaN 不進累積和，只在仍位於視窗內時讓結果為 NaN
+   values = np.asarray(values, dtype=float)
+   bad = ~np.isfinite(values)
+   csum = np.cumsum(np.where(bad, 0.0, values))
+   bad_csum = np.cumsum(bad)
+   out = csum.copy()
+   out[window:] = csum[window:] - csum[:-window]
+   bad_count = bad_csum.copy()
+   bad_count[window:] = bad_csum[window:] - bad_csum[:-window]
+   out[bad_count > 0] = np.nan
+   out[:window - 1] = np.nan
+   return out
+
 def calculate_technical_indicators(df):
+   # 回傳 {指標名稱: ndarray}，不複製 df、也不在 df 上加中間欄位
    if df.empty or len(df) < 20:
-       return df # 數據不足直接回傳
+       return {} # 數據不足回傳空指標
        
-   df = df.copy()
+   o, h, l, c = df['Open'].values, df['High'].values, df['Low'].values, df['Close'].values
+   v = df['Volume'].values
    
    # VWAP (10日)
-   df['TP'] = (df['High'] + df['Low'] + df['Close']) / 3
-   df['PV'] = df['TP'] * df['Volume']
-   df['Rolling_VWAP_10D'] = df['PV'].rolling(window=10).sum() / df['Volume'].rolling(window=10).sum()
-   
-   # MFI (14日)
-   typical_price = (df['High'] + df['Low'] + df['Close']) / 3
-   money_flow = typical_price * df['Volume']
-   
-   positive_flow = [0] * len(df)
-   negative_flow = [0] * len(df)
+   tp = (h + l + c) / 3
+   pv = tp * v
+   vwap = rolling_sum(pv, 10) / rolling_sum(v, 10)
    
-   for i in range(1, len(df)):
-       if typical_price.iloc[i] > typical_price.iloc[i-1]:
-           positive_flow[i] = money_flow.iloc[i]
-       elif typical_price.iloc[i] < typical_price.iloc[i-1]:
-           negative_flow[i] = money_flow.iloc[i]
+   # MFI (14日)：典型價與資金流即 VWAP 的 tp / pv，直接沿用
+   # 向量化判斷資金流向：以符號相乘一次得到帶正負號的資金流 (持平或無法比較為 0，同 diff 的 NaN 行為)
+   delta = np.diff(tp, prepend=tp[0])
+   sign = np.nan_to_num(np.sign(delta))
+   signed_mf = np.where(sign != 0, pv * sign, 0.0)
+   positive_flow = np.clip(signed_mf, 0, None)
+   negative_flow = -np.clip(signed_mf, None, 0)
            
-   df['PosMF'] = pd.Series(positive_flow).rolling(window=14).sum()
-   df['NegMF'] = pd.Series(negative_flow).rolling(window=14).sum()
+   pos_mf = rolling_sum(positive_flow, 14)
+   neg_mf = rolling_sum(negative_flow, 14)
    
    # 防呆：避免除以零
-   mfi_ratio = df['PosMF'] / df['NegMF'].replace(0, 1)
-   df['MFI'] = 100 - (100 / (1 + mfi_ratio))
+   mfi_ratio = pos_mf / np.where(neg_mf == 0, 1, neg_mf)
+   mfi = 100 - (100 / (1 + mfi_ratio))
    
-   # K線與背離
-   df['MFI_Divergence'] = df['MFI'] < 25 
+   # K線與背離 (直接用 ndarray 運算，省去 Series 的索引對齊開銷)
+   body = np.abs(c - o)
+   lower_shadow = np.minimum(o, c) - l
+   upper_shadow = h - np.maximum(o, c)
+   is_hammer = (lower_shadow >= body * 2) & (upper_shadow <= body * 0.5)
    
-   body = abs(df['Close'] - df['Open'])
-   lower_shadow = np.minimum(df['Open'], df['Close']) - df['Low']
-   upper_shadow = df['High'] - np.maximum(df['Open'], df['Close'])
-   df['Is_Hammer'] = (lower_shadow >= body * 2) & (upper_shadow <= body * 0.5)
+   engulfing = (c[1:] > o[1:]) & \
+               (o[1:] < c[:-1]) & \
+               (c[1:] > o[:-1]) & \
+               (c[:-1] < o[:-1])
    
-   df['Is_Engulfing'] = (df['Close'] > df['Open']) & \
-                        (df['Open'] < df['Close'].shift(1)) & \
-                        (df['Close'] > df['Open'].shift(1)) & \
-                        (df['Close'].shift(1) < df['Open'].shift(1))
-   
-   return df
+   return {
+       'Rolling_VWAP_10D': vwap,
+       'MFI': mfi,
+       'MFI_Divergence': mfi < 25,
+       'Is_Hammer': is_hammer,
+       'Is_Engulfing': np.concatenate([[False], engulfing]),
+   }
+
+# 只讀取最新一根的指標：VWAP 需 10 根、MFI 需 15 根，取 max(20, 14) + 5 根即足夠
+INDICATOR_LOOKBACK = max(20, 14) + 5
+
+@st.cache_data(max_entries=100) # UI 互動造成的 rerun 不必重算整段指標
+def compute_indicators(ticker, bar_key, _df):
+   # _df 前綴底線：不對整個 DataFrame 做雜湊，快取鍵僅為 (ticker, 最後一根 K 線)
+   return calculate_technical_indicators(_df.tail(INDICATOR_LOOKBACK))
+
+def last_bar_key(df):
+   # 當日 K 線盤中仍會變動，因此把最後收盤價與成交量一起納入鍵值
+   return (df.index[-1], len(df), float(df['Close'].values[-1]), float(df['Volume'].values[-1]))
+
+def error_result(advice):
+   return {"verdict": "❌ 數據錯誤", "color": "red", "score": 0, "advice": advice, "reasons": [], "data": {}}
 
 def rainow_brain(ticker, hist_daily, rt_data, info):
    # --- Step 0: 優先計算技術指標 (修復 Bug: 避免提早回傳導致 MFI 缺失) ---
    if hist_daily.empty:
-       return {"verdict": "❌ 數據錯誤", "color": "red", "score": 0, "advice": "無法取得歷史數據", "reasons": [], "data": {}}
+       return error_result("無法取得歷史數據")
        
-   df_daily = calculate_technical_indicators(hist_daily)
-   latest_daily = df_daily.iloc[-1]
+   ind = compute_indicators(ticker, last_bar_key(hist_daily), hist_daily)
+   last_close = hist_daily['Close'].values[-1]
+   last_low = hist_daily['Low'].values[-1]
    
-   # 獲取指標 (使用 get 安全獲取，若計算失敗給預設值)
-   vwap = latest_daily.get('Rolling_VWAP_10D', 0)
-   mfi_val = latest_daily.get('MFI', 50) # 預設 50 中性
+   # 獲取指標 (數據不足時 ind 為空，給預設值)
+   vwap = ind['Rolling_VWAP_10D'][-1] if ind else 0
+   mfi_val = ind['MFI'][-1] if ind else 50 # 預設 50 中性
    if pd.isna(mfi_val): mfi_val = 50
-   if pd.isna(vwap): vwap = latest_daily['Close']
+   if pd.isna(vwap): vwap = last_close
 
    # --- Step 1: 決定當前價格 (增強版邏輯) ---
    price_source = "日線收盤價"
-   current_price = latest_daily['Close']
+   current_price = last_close
    
    if not rt_data.empty:
        last_price = rt_data['Close'].iloc[-1]
@@ -102,8 +171,7 @@ def rainow_brain(ticker, hist_daily, rt_data, info):
            current_price = last_price
            # 轉換時區
            try:
-               tz_ny = pytz.timezone('America/New_York')
-               last_time_ny = last_time.astimezone(tz_ny)
+               last_time_ny = last_time.astimezone(_TZ_NY)
                price_source = f"即時報價 ({last_time_ny.strftime('%H:%M')} NY)"
            except:
                price_source = "即時報價"
@@ -114,7 +182,8 @@ def rainow_brain(ticker, hist_daily, rt_data, info):
    val_source = "華爾街分析師"
    
    if target_low is None:
-       ma50 = hist_daily['Close'].rolling(50).mean().iloc[-1]
+       closes = hist_daily['Close'].values
+       ma50 = closes[-50:].mean() if len(closes) >= 50 else np.nan
        if pd.isna(ma50): ma50 = current_price
        target_low = ma50 * 0.8
        target_high = ma50 * 1.2
@@ -169,7 +238,7 @@ def rainow_brain(ticker, hist_daily, rt_data, info):
 
    if current_price > vwap:
        score += 1
-       if latest_daily.get('Low', 0) <= vwap * 1.02 and current_price > vwap:
+       if last_low <= vwap * 1.02 and current_price > vwap:
            score += 2
            reasons.append("🛡️ 機構在成本線護盤 (回踩有撐)")
        else:
@@ -179,10 +248,10 @@ def rainow_brain(ticker, hist_daily, rt_data, info):
        reasons.append(f"⚠️ 跌破機構成本線 ({bias:.1f}%)")
        
    # 4. 技術訊號
-   if latest_daily.get('Is_Hammer') or latest_daily.get('Is_Engulfing'):
+   if ind and (ind['Is_Hammer'][-1] or ind['Is_Engulfing'][-1]):
        score += 2
        reasons.append("🕯️ 日線出現底部反轉訊號")
-   if latest_daily.get('MFI_Divergence'):
+   if ind and ind['MFI_Divergence'][-1]:
        score += 2
        reasons.append("💰 MFI 進入超賣吸籌區")
 
@@ -222,6 +291,29 @@ def rainow_brain(ticker, hist_daily, rt_data, info):
        }
    }
 
+def analyze_one(ticker, bucket=None):
+   if bucket is None:
+       bucket = price_bucket()
+   hist_daily, rt_data, info = get_stock_data(ticker, bucket)
+   return rainow_brain(ticker, hist_daily, rt_data, info)
+
+def analyze_many(tickers, max_workers=16):
+   # 多檔標的平行分析：瓶頸在 HTTP，用執行緒池隱藏網路延遲
+   if not tickers:
+       return {}
+   bucket = price_bucket()
+   results = {}
+   with ThreadPoolExecutor(max_workers=min(max_workers, len(tickers))) as ex:
+       futures = {ex.submit(analyze_one, t, bucket): t for t in tickers}
+       for future in as_completed(futures):
+           ticker = futures[future]
+           # 單一標的失敗 (代碼錯誤 / 被限流) 不影響其他標的的結果
+           try:
+               results[ticker] = future.result()
+           except Exception as e:
+               results[ticker] = error_result(str(e))
+   return {t: results[t] for t in tickers}
+
 # --- 介面呈現 (UI) ---
 
 st.title("🧠 Rainow 量化戰情室 Pro (V3.1)")
@@ -238,7 +330,7 @@ with st.sidebar:
 if ticker_input:
    try:
        with st.spinner(f"正在連線即時報價系統分析 {ticker_input} ..."):
-           hist_daily, rt_data, info = get_stock_data(ticker_input)
+           hist_daily, rt_data, info = get_stock_data(ticker_input, price_bucket())
            
            if hist_daily.empty:
                st.error("❌ 找不到數據，請確認代碼。")